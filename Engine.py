@@ -18,24 +18,29 @@ logger = log.get_logger()
 # when an exception occurs, we will handle it with the log function
 sys.excepthook = log.exception_logging
 
+# initialize tranform object and get the most recent call time already in Snowflake, so that only newer calls are
+# extracted
+# the transform object's Snowflake connection is shared by the rest of the run
+t = Transform(data_config)
+max_datetime = t.get_max_snowflake_time()
+
 # initialize extract object and extract data
 logger.info('Begin extract data...')
 e = Extract(data_config)
-call_df = e.extract_data(use_date_range=False)
+call_df = e.extract_data(use_date_range=False, since=max_datetime)
 logger.info('Data sucessfully extracted. Begin downloading extracted data...')
 
 # download extracted data
 e.download_extracted_data()
 logger.info('Extracted data successfully downloaded. Begin transform data...')
 
-# initialize tranform object and transform data
-t = Transform(data_config)
+# transform data
 call_df = t.transform_data(call_df)
 logger.info('Data sucessfully transformed. Begin load data into Snowflake...')
 
 # initialize load object and load call data into Snowflake
-l = Load(data_config)
-l.load_table(call_df, 'Zoom_Call_Logs')
+l = Load(data_config, conn=t.get_connection())
+l.load_table(call_df, data_config['transform']['table_name'])
 l.load_source_data()
 logger.info('Data sucessfully loaded into Snowflake.')
 
@@ -43,8 +48,11 @@ logger.info('Data sucessfully loaded into Snowflake.')
 # this only needs to be ran once, or if the table has been removed
 # log.create_log_table(l)
 
-# load log file into Snowflake
-log.load_log()
+# load log file into Snowflake, reusing the shared connection
+log.load_log(t.get_connection())
+
+# close the shared Snowflake connection
+t.close()
 
 # close log
 log.close_log()
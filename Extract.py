@@ -1,13 +1,24 @@
 import jwt
+import orjson
+from collections import deque
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from requests import Session
-from time import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from time import time, monotonic, sleep
 import pandas as pd
-from ratelimiter import RateLimiter
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 from Log import Log
 
+# cache of generated jwt tokens, keyed on (API_KEY, API_SECRET), holding (token, expiration time)
+_TOKEN_CACHE = {}
+
 
 class Extract:
     """
@@ -23,12 +34,16 @@ class Extract:
         Gets start and end date to pull data from.
     get_token():
         Generates a request token from the API key and secret using the pyjwt library.
-    is_positive():
-        Takes in an integer n, returns 1 if the number is positive, else returns 0.
     limited_request_get():
         Makes http requests without exceeding the max number of requests per second (5) for the api.
+    get_date_windows():
+        Splits a date range into consecutive windows of whole days.
+    get_call_logs():
+        Makes http requests to get call log data from Zoom API.
+    get_window_call_logs():
+        Makes http requests to get the call log pages for a single date window.
     def download_extracted_data(self):
-        Downloads extracted data as csv
+        Downloads extracted data as gzip compressed csv
     """
     def __init__(self, data_config):
         """
@@ -52,16 +67,27 @@ class Extract:
         self.num_periods = data_config['extract']['num_periods']
         self.start_date = data_config['extract']['start_date']
         self.end_date = data_config['extract']['end_date']
+        # extracted data is downloaded gzip compressed, before it is staged in Snowflake
         self.download_path = data_config['extract']['download_path']
 
         # untransformed data
         self.extracted_data = pd.DataFrame()
 
+        # times of the most recent requests to the api, used to stay within 5 requests per second
+        self.request_times = deque(maxlen=5)
+        self.request_lock = Lock()
+
+        # initalize Session object, shared by all worker threads
+        # keep a connection open for each worker thread, and retry rate limited or failed requests with backoff
+        self.session = Session()
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=5, max_retries=retries))
+
         # initialize logger
         self.log = Log('zoom_log', data_config)
         self.logger = self.log.get_logger()
 
-    def extract_data(self, use_date_range):
+    def extract_data(self, use_date_range, since=None):
         """
         Extracts data from Zoom through the API.
 
@@ -70,6 +96,8 @@ class Extract:
         use_date_range : bool
             specifies whether to extract data from a date range. If false, use the period paramater in the
             data_config to pull the day, month, or year of data up until the start date.
+        since : datetime
+            most recent call time already loaded. If given, days before it are not requested from Zoom.
 
         Returns
         _______
@@ -80,6 +108,17 @@ class Extract:
         # get date range to pull data from
         start_date, end_date = self.get_date_range(use_date_range)
 
+        # skip days that have already been loaded
+        # start a day before since, so a difference between the Zoom account's time zone and UTC cannot skip calls
+        # the calls pulled from before since are filtered out in the transform step
+        # the start date is never moved past the end date, so a date range that ends before since still makes a valid
+        # request
+        if not pd.isna(since):
+            since_date = min((since - relativedelta(days=1)).strftime('%Y-%m-%d'), end_date)
+            if since_date > start_date:
+                self.logger.info(f'Calls up to {since} are already loaded, moving start date to {since_date}')
+                start_date = since_date
+
         # pull call logs from Zoom API into a pandas dataframe
         df = self.get_call_logs(start_date, end_date, self.page_size)
 
@@ -150,31 +189,35 @@ class Extract:
 
     def generate_token(self):
         """
-        Generates a request token from the API key and secret using the pyjwt library.
+        Generates a request token from the API key and secret using the pyjwt library. Tokens are cached and reused
+        until they are within a minute of expiring.
 
         Returns
         _______
         token : str
             request token for accessing the Zoom Api
         """
+        key = (self.API_KEY, self.API_SECRET)
+
+        # reuse the cached token if it is not about to expire
+        cached = _TOKEN_CACHE.get(key)
+        if cached is not None:
+            token, expiry = cached
+            if time() < expiry - 60:
+                return token
+
+        expiry = time() + 5000
         token = jwt.encode(
             # create a payload of the token containing API Key & expiration time
-            {'iss': self.API_KEY, 'exp': time() + 5000},
+            {'iss': self.API_KEY, 'exp': expiry},
             # secret used to generate token signature
             self.API_SECRET,
             # specify the hashing alg
             algorithm='HS256'
         )
+        _TOKEN_CACHE[key] = (token, expiry)
         return token
 
-    def is_positive(self, n):
-        """Takes in an integer n, returns 1 if the number is positive, else returns 0."""
-        if n > 0:
-            return 1
-        else:
-            return 0
-
-    @RateLimiter(max_calls=5, period=1)
     def limited_request_get(self, session, url, headers):
         """
         Makes http requests without exceeding the max number of requests per second (5) for the api.
@@ -193,13 +236,58 @@ class Extract:
         req : Response object
             reponse object from the API request
         """
+
+        # if the last 5 requests were made within the last second, wait until the oldest of them is a second old
+        # the lock makes worker threads take turns, so the limit holds across all of them
+        with self.request_lock:
+            if len(self.request_times) == 5:
+                elapsed = monotonic() - self.request_times[0]
+                if elapsed < 1:
+                    sleep(1 - elapsed)
+            self.request_times.append(monotonic())
+
         req = session.get(url, headers=headers)
         return req
 
+    def get_date_windows(self, start_date, end_date, num_windows):
+        """
+        Splits a date range into consecutive windows of whole days, of as equal length as possible.
+
+        Parameters
+        __________
+        start_date : str
+            start date of the date range
+        end_date : str
+            end date of the date range
+        num_windows : int
+            number of windows to split the date range into. There is never more than one window per day.
+
+        Returns
+        _______
+        windows : list
+            list of (start_date, end_date) tuples, one for each window in the date range
+        """
+
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+
+        # number of days in each window (ceiling division)
+        num_days = (end - start).days + 1
+        window_days = -(-num_days // max(1, min(num_windows, num_days)))
+
+        windows = []
+        while start <= end:
+            window_end = min(start + relativedelta(days=window_days - 1), end)
+            windows.append((start.strftime('%Y-%m-%d'), window_end.strftime('%Y-%m-%d')))
+            start = window_end + relativedelta(days=1)
+
+        return windows
+
     def get_call_logs(self, start_date, end_date, page_size):
         """
-        Makes http requests to get call log data from Zoom API. Calculates how many pages to request based on number
-        of call records.
+        Makes http requests to get call log data from Zoom API. The first page of the whole date range is requested
+        first. If there are more pages, the date range is split into about one window per page, and the windows are
+        requested concurrently, since the next_page_token pagination of a single window can only be walked serially.
 
         Parameters
         __________
@@ -224,29 +312,105 @@ class Extract:
         if page_size > 300:
             raise ValueError(f'page_size value of {page_size} exceeds that maximum value of 300.')
 
-        # create initial request url
+        # request the first page of the whole date range, which tells us how many pages of calls there are
         url = f'https://api.zoom.us/v2/phone/call_logs?page_size={page_size}&from={start_date}&to={end_date}'
+        first_page = orjson.loads(self.limited_request_get(self.session, url, header).content)
+        pages = -(-first_page['total_records'] // page_size)
+
+        if pages <= 1:
+            # every call is on the first page, so there is nothing more to request
+            batches = self.get_window_call_logs(self.session, header, start_date, end_date, page_size, first_page)
+        else:
+            # request windows of the date range on their own worker threads, sized so that each window holds about a
+            # page of calls
+            # the rate limiter on limited_request_get keeps the combined request rate within the api limit, so there
+            # is no benefit to having more workers than the max number of requests per second (5)
+            windows = self.get_date_windows(start_date, end_date, pages)
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                window_logs = executor.map(
+                    lambda window: self.get_window_call_logs(self.session, header, window[0], window[1], page_size),
+                    windows)
+                # flatten the record batches of every window in one pass, keeping the windows in date order
+                batches = list(chain.from_iterable(window_logs))
+
+        # wrap each batch in a single batch table
+        tables = [pa.Table.from_batches([batch]) for batch in batches]
+        del batches
+
+        # if there were no calls, log it and return an empty dataframe
+        if not tables:
+            self.logger.error(f'No records available between {start_date} and {end_date}')
+            self.extracted_data = pd.DataFrame()
+            return self.extracted_data
+
+        # combine the batches into one table
+        # pages can disagree on columns or types (e.g. a field that is null for a whole page), so unify the schemas
+        table = pa.concat_tables(tables, promote_options='permissive')
+        del tables
+
+        # a field that is null in every record has arrow's null type, which has no Snowflake type, so load it as a
+        # string column, as it was before the columns were arrow backed
+        if any(pa.types.is_null(field.type) for field in table.schema):
+            table = table.cast(pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                          for field in table.schema]))
+
+        # convert to a pandas dataframe with arrow backed columns, so later steps work on arrow buffers rather than
+        # python objects
+        call_df = table.to_pandas(types_mapper=pd.ArrowDtype, split_blocks=True, self_destruct=True)
+        del table
+
+        self.extracted_data = call_df
 
-        # initalize Session object
-        session = Session()
+        return call_df
 
-        # initialize the number of pages, a list to hold dictionaries obtained from responses, and a counter
+    def get_window_call_logs(self, session, header, start_date, end_date, page_size, first_page=None):
+        """
+        Makes http requests to get the call log pages for a single date window. Calculates how many pages to request
+        based on number of call records.
+
+        Parameters
+        __________
+        session : Session object
+            requests Session object for making http requests
+        header : dict
+            header for authorization and specifying content type in http request
+        start_date : str
+            start date to pull data from
+        end_date : str
+            end date to pull data from
+        page_size : int
+            number of records to pull per page (max 300)
+        first_page : dict
+            decoded response of the window's first page, if it has already been requested
+
+        Returns
+        _______
+        batches : list
+            list of pyarrow RecordBatches holding the call logs, one for each page
+        """
+
+        # create initial request url
+        url = f'https://api.zoom.us/v2/phone/call_logs?page_size={page_size}&from={start_date}&to={end_date}'
+
+        # initialize the number of pages, a list to hold record batches built from responses, and a counter
         pages = 0
-        log_dicts = []
+        batches = []
         counter = 0
 
         # submit requests, updating the url with a next_page_token each time, until the number of pages equals the
         # counter
         while True:
-            # submit initial request
-            response = self.limited_request_get(session, url, header)
+            # use the first page if it has already been requested, otherwise submit the request
+            if counter == 0 and first_page is not None:
+                log_dict = first_page
+            else:
+                response = self.limited_request_get(session, url, header)
+                # get call data as a dictionary, decoding the raw response bytes with orjson
+                log_dict = orjson.loads(response.content)
 
             # increment counter
             counter += 1
 
-            # get call data as a dictionary
-            log_dict = response.json()
-
             # on our first loop, calculate number of pages
             if counter == 1:
                 records = log_dict['total_records']
@@ -254,15 +418,17 @@ class Extract:
                 self.logger.info(f'{records} records available between {start_date} and {end_date}')
                 # if there were no calls, stop
                 if records == 0:
-                    self.logger.error(f'No records available between {start_date} and {end_date}')
                     break
 
                 # calculate the number of pages to request
                 # if there are any left over calls that did not make up a full page, we will add a page for them
-                pages = records // page_size + self.is_positive(records % page_size)
+                # (ceiling division)
+                pages = -(-records // page_size)
 
-            # append dictionary to list of log_dicts
-            log_dicts.append(log_dict)
+            # convert the page's call logs to a record batch
+            # building a struct array first infers the columns from every record, not only the first
+            if log_dict['call_logs']:
+                batches.append(pa.RecordBatch.from_struct_array(pa.array(log_dict['call_logs'])))
 
             # when we reach the desired number of pages, stop
             # if we don't stop, it will loop back to the beginning (within date requirements)
@@ -274,29 +440,29 @@ class Extract:
             url = f'https://api.zoom.us/v2/phone/call_logs?page_size=' \
                   f'{page_size}&next_page_token={next_page_token}&from={start_date}&to={end_date}'
 
-        # get only call logs from reponse dictionaries in log_dicts
-        call_list = list(map(lambda d: d['call_logs'], log_dicts))
-
-        # convert list of lists of dictionaries to a list of dictionaries
-        call_list = [call_dict for sublist in call_list for call_dict in sublist]
-
-        # convert to a pandas dataframe
-        call_df = pd.DataFrame(call_list)
-
-        self.extracted_data = call_df
-
-        return call_df
+        return batches
 
     def download_extracted_data(self):
         """
-        Downloads extracted data as csv
+        Downloads extracted data as gzip compressed csv
 
         Returns
         _______
         None
         """
 
-        self.extracted_data.to_csv(self.download_path)
+        table = pa.Table.from_pandas(self.extracted_data, preserve_index=False)
+
+        # the pyarrow csv writer does not support nested columns, so write those as json strings
+        for i, field in enumerate(table.schema):
+            if pa.types.is_nested(field.type):
+                values = [None if value is None else orjson.dumps(value).decode()
+                          for value in table.column(i).to_pylist()]
+                table = table.set_column(i, field.name, pa.array(values, type=pa.string()))
+
+        # write gzip compressed csv with pyarrow's multithreaded writer
+        with pa.CompressedOutputStream(self.download_path, 'gzip') as out:
+            pacsv.write_csv(table, out)
 
 
 
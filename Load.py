@@ -1,10 +1,53 @@
+import os
 import pandas as pd
 import snowflake.connector
-from snowflake.connector.pandas_tools import write_pandas
-from datetime import datetime, timedelta
+from datetime import datetime
+from tempfile import TemporaryDirectory
 
 from Log import Log
 
+# cache of the most recent call time and row count of call log tables, keyed on (ACCOUNT, DATABASE, SCHEMA, table_name,
+# datetime_column, lookback_days), holding (max_datetime, row_count, row_count_days, expiration time)
+# Transform.bootstrap fills it, and Load.load_table clears a table's entries once it has loaded rows into the table
+MAX_DATETIME_CACHE = {}
+
+
+def connect_snowflake(user, password, account, warehouse, database, schema):
+    """
+    Opens a connection to Snowflake, set to use the given warehouse, database, and schema. The connection is kept
+    alive between queries, so it can be shared by the Transform and Load objects for a whole run.
+
+    Parameters
+    __________
+    user : str
+        Snowflake user name
+    password : str
+        Snowflake password
+    account : str
+        Snowflake account identifier
+    warehouse : str
+        warehouse to use
+    database : str
+        database to use
+    schema : str
+        schema to use
+
+    Returns
+    _______
+    conn : SnowflakeConnection
+        open connection to Snowflake
+    """
+
+    return snowflake.connector.connect(
+        user=user,
+        password=password,
+        account=account,
+        warehouse=warehouse,
+        database=database,
+        schema=schema,
+        client_session_keep_alive=True
+    )
+
 
 class Load:
     """
@@ -20,9 +63,15 @@ class Load:
         Produces a SQL CREATE statement to create a specified table with appropriate columns and data types.
     load_source_data():
         Load the data that was pulled directly from Zoom, prior to transformation, into a Snowflake stage.
+    get_connection():
+        Gets the Snowflake connection shared by this object, connecting on first use.
+    bootstrap():
+        Creates the Snowflake objects used for loading if they do not exist, once per connection.
+    close():
+        Closes the shared Snowflake connection.
     """
 
-    def __init__(self, data_config):
+    def __init__(self, data_config, conn=None):
         """
         Constructs all the necessary attributes for the Load object.
 
@@ -30,6 +79,9 @@ class Load:
         __________
             data_config : dict
                 dictionary containing ETL specifications
+            conn : SnowflakeConnection
+                open connection to Snowflake to share with other objects. If None, a connection is opened on first
+                use and closed by close().
         """
 
         # get Snowflake parameters from data_config
@@ -43,33 +95,61 @@ class Load:
 
         # columns in dataframe that must be converted to datetime in Snowflake
         self.datetime_columns = data_config['load']['datetime_columns']
+        # the same columns, named as they are in Snowflake
+        self.snowflake_datetime_columns = [col.upper().replace(' ', '_') for col in self.datetime_columns]
 
         # stage information
         self.days_to_stage = data_config['load']['days_to_stage']
+
+        # number of rows per file uploaded by load_table, and number of threads used to upload the files
+        self.chunk_size = data_config['load']['chunk_size']
+        self.parallel = min(os.cpu_count() or 1, data_config['load']['parallel'])
+        # the extracted data is downloaded gzip compressed
         self.extract_path = data_config['extract']['download_path']
 
+        # Snowflake connection shared by all loads, created on first use unless one was passed in
+        # a connection that was passed in belongs to the caller, and is not closed by this object
+        self.conn = conn
+        self.owns_conn = conn is None
+        # whether the warehouse, database, schema, and stage have been set up on the shared connection
+        self.bootstrapped = False
+
         # initialize logger
         self.log = Log('zoom_log', data_config)
         self.logger = self.log.get_logger()
 
-    def load_table(self, df, table_name):
+    def get_connection(self):
         """
-        Loads Zoom data into a Snowflake table.
+        Gets the Snowflake connection shared by this object, connecting on first use.
+
+        Returns
+        _______
+        conn : SnowflakeConnection
+            open connection to Snowflake
+        """
+
+        # connect to snowflake only once per Load object
+        if self.conn is None:
+            self.conn = connect_snowflake(self.USER, self.PASSWORD, self.ACCOUNT, self.WAREHOUSE, self.DATABASE,
+                                          self.SCHEMA)
+
+        return self.conn
+
+    def bootstrap(self):
+        """
+        Creates the warehouse, database, schema, and stage used for loading if they do not exist, and sets the
+        warehouse, database, and schema for the shared connection. Only runs once per connection.
 
         Returns
         _______
         None
         """
 
-        # connect to snowflake
-        conn = snowflake.connector.connect(
-            user=self.USER,
-            password=self.PASSWORD,
-            account=self.ACCOUNT
-        )
+        if self.bootstrapped:
+            return
 
         # get cursor
-        cur = conn.cursor()
+        cur = self.get_connection().cursor()
 
         # create warehouse, db, and schema if not exists
         cur.execute(f'CREATE WAREHOUSE IF NOT EXISTS {self.WAREHOUSE}')
@@ -77,21 +157,82 @@ class Load:
         cur.execute(f'USE DATABASE {self.DATABASE}')
         cur.execute(f'CREATE SCHEMA IF NOT EXISTS {self.SCHEMA}')
 
-        # specify the warehouse, database, and schema to use when creating the table
+        # specify the warehouse, database, and schema to use for the rest of the session
         cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
         cur.execute(f'USE SCHEMA {self.SCHEMA}')
 
+        # create stage if it doesn't exist
+        cur.execute(f'CREATE STAGE IF NOT EXISTS {self.STAGE}')
+
+        self.bootstrapped = True
+
+    def close(self):
+        """
+        Closes the shared Snowflake connection, if it was opened by this object.
+
+        Returns
+        _______
+        None
+        """
+
+        if self.conn is not None and self.owns_conn:
+            self.conn.close()
+            self.conn = None
+            self.bootstrapped = False
+
+    def load_table(self, df, table_name):
+        """
+        Loads Zoom data into a Snowflake table.
+
+        Returns
+        _______
+        None
+        """
+
+        # make sure the warehouse, database, and schema exist and are in use
+        self.bootstrap()
+
+        # get cursor
+        cur = self.get_connection().cursor()
+
         # create table if it doesn't exist, using create string method
-        create_str = self.get_create_string(table_name, df, self.datetime_columns)
+        create_str = self.get_create_string(table_name, df)
         cur.execute(create_str)
 
         # log table load
         self.logger.info(f'Loading {table_name}...')
 
-        # write data to Snowflake
-        success, num_chunks, num_rows, _ = write_pandas(conn, df, table_name, self.DATABASE, self.SCHEMA,
-                                                        quote_identifiers=False)
+        # write data to snappy compressed parquet files of at most chunk_size rows and upload them to the table's
+        # stage, using parallel threads for the upload
+        # (always write at least one file, so an empty dataframe still uploads a file for PUT to find)
+        file_names = []
+        with TemporaryDirectory() as tmp_dir:
+            for start in range(0, max(len(df), 1), self.chunk_size):
+                file_name = f'{table_name}_{len(file_names)}.parquet'
+                df.iloc[start:start + self.chunk_size].to_parquet(os.path.join(tmp_dir, file_name), engine='pyarrow',
+                                                                  compression='snappy', index=False)
+                file_names.append(file_name)
+            cur.execute(f"PUT 'file://{os.path.join(tmp_dir, '*.parquet')}' @%{table_name} AUTO_COMPRESS=FALSE "
+                        f"OVERWRITE=TRUE PARALLEL={self.parallel}")
+
+        # copy the staged files into the table, matching parquet columns to table columns by name
+        # Snowflake loads the files concurrently, so the warehouse size is the other lever on load time
+        # only the files we just uploaded are listed, and PURGE removes them from the table's stage once loaded
+        files_sql = ', '.join(f"'{file_name}'" for file_name in file_names)
+        copy_results = cur.execute(f'COPY INTO {table_name} FILES=({files_sql}) FILE_FORMAT=(TYPE=PARQUET) '
+                                   f'MATCH_BY_COLUMN_NAME=CASE_INSENSITIVE PURGE=TRUE').fetchall()
+
+        # each row of the COPY result describes one file: (file, status, rows_parsed, rows_loaded, ...)
+        # if no files were copied, the result is a single row containing only a status message
+        file_results = [row for row in copy_results if len(row) > 3]
+
+        # the table's cached most recent call time is out of date once rows are loaded, so clear it, otherwise a later
+        # run in this process would load the same calls again
+        table_key = (self.ACCOUNT, self.DATABASE, self.SCHEMA, table_name)
+        for key in [key for key in MAX_DATETIME_CACHE if key[:4] == table_key]:
+            del MAX_DATETIME_CACHE[key]
+        success = all(row[1] == 'LOADED' for row in file_results)
+        num_rows = sum(row[3] for row in file_results)
 
         # log success status of table load
         if success:
@@ -99,10 +240,7 @@ class Load:
         else:
             self.logger.error(f'{table_name} table load unsuccessful')
 
-        # close Snowflake connector
-        conn.close()
-
-    def get_create_string(self, table_name, df, datetime_columns):
+    def get_create_string(self, table_name, df, datetime_columns=None):
         """
         Produces a SQL CREATE statement to create a specified table with appropriate columns and data types.
 
@@ -113,7 +251,8 @@ class Load:
         df : Pandas DataFrame
             dataframe that holds data to be loaded into Snowflake
         datetime_columns : list
-            list of columnsthat must be converted to datetime upon loading into Snowflake
+            list of columnsthat must be converted to datetime upon loading into Snowflake. If None, the datetime
+            columns from the load section of the data_config are used.
 
         Returns
         _______
@@ -123,28 +262,67 @@ class Load:
 
         # dictionary of type conversions from pandas to snowflake
         dtype_conversions = {'object': 'string',
+                             'int8': 'integer',
+                             'int16': 'integer',
+                             'int32': 'integer',
                              'int64': 'integer',
                              'Int64': 'integer',
                              'datetime64[ns]': 'TIMESTAMP_NTZ(9))',
+                             'float32': 'REAL',
                              'float64': 'REAL',
                              'boolean': 'BOOLEAN',
-                             'category': 'string'}
-
-        # get dictionary of data types of df for each column
-        # here, "apply" allows us to get the data types as strings
-        dtypes = df.dtypes.apply(lambda x: x.name).to_dict()
-
-        # replace pandas types with snowflake types using conversion dictionary
-        dtypes = {col: dtype_conversions[dtype] for col, dtype in dtypes.items()}
+                             'category': 'string',
+                             'string': 'string',
+                             'str': 'string',
+                             # arrow backed types
+                             'string[pyarrow]': 'string',
+                             'large_string[pyarrow]': 'string',
+                             'null[pyarrow]': 'string',
+                             'nested[pyarrow]': 'string',
+                             'int8[pyarrow]': 'integer',
+                             'int16[pyarrow]': 'integer',
+                             'int32[pyarrow]': 'integer',
+                             'int64[pyarrow]': 'integer',
+                             'uint8[pyarrow]': 'integer',
+                             'uint16[pyarrow]': 'integer',
+                             'uint32[pyarrow]': 'integer',
+                             'uint64[pyarrow]': 'integer',
+                             'halffloat[pyarrow]': 'REAL',
+                             'float[pyarrow]': 'REAL',
+                             'double[pyarrow]': 'REAL',
+                             'bool[pyarrow]': 'BOOLEAN',
+                             'timestamp[pyarrow]': 'TIMESTAMP_NTZ(9)',
+                             'date32[day][pyarrow]': 'DATE',
+                             'date64[ms][pyarrow]': 'DATE'}
+
+        # get the pandas type of each column as a string
+        # nested arrow types include their fields in their names, so they are grouped under one name, and arrow
+        # timestamps of every unit and time zone are grouped under another
+        dtype_names = (df.dtypes.astype(str)
+                       .str.replace(r'^(struct|list|large_list|map)<.*\[pyarrow\]$', 'nested[pyarrow]', regex=True)
+                       .str.replace(r'^timestamp\[.*\]\[pyarrow\]$', 'timestamp[pyarrow]', regex=True))
+
+        # replace the pandas type of each column with its snowflake type using conversion dictionary
+        sf_types = dtype_names.map(dtype_conversions)
+
+        # ensure every pandas type has a snowflake conversion
+        unknown_types = df.dtypes[sf_types.isna()].astype(str).unique().tolist()
+        if unknown_types:
+            raise ValueError(f'No Snowflake type conversion for pandas types {unknown_types}.')
+
+        sf_types = sf_types.to_dict()
 
         # we have a few datetime columns that are technically string type
         # we want to convert these to TIMESTAMP_NTZ(9) upon loading, so we will alter the dictionary so this happens
-        for col in datetime_columns:
-            dtypes[col.upper().replace(' ', '_')] = 'TIMESTAMP_NTZ(9)'
+        if datetime_columns is None:
+            sf_datetime_columns = self.snowflake_datetime_columns
+        else:
+            sf_datetime_columns = [col.upper().replace(' ', '_') for col in datetime_columns]
+        sf_types.update({col: 'TIMESTAMP_NTZ(9)' for col in sf_datetime_columns})
 
-        # make a create statement string form the dtypes dictionary
-        create_str = f'CREATE TABLE IF NOT EXISTS {table_name}(' + \
-                     ', '.join([f'"{key}" {value}' for key, value in dtypes.items()]) + ')'
+        # make a create statement string form the sf_types dictionary
+        cols_sql = ', '.join(f'"{key}" {value}' for key, value in sf_types.items())
+        create_str = f'CREATE TABLE IF NOT EXISTS {table_name}({cols_sql})'
 
         return create_str
 
@@ -160,27 +338,17 @@ class Load:
         # today's date
         today = datetime.now().strftime('%Y-%m-%d')  # Year-Month-Day format
 
-        # connect to Snowflake
-        conn = snowflake.connector.connect(
-            user=self.USER,
-            password=self.PASSWORD,
-            account=self.ACCOUNT
-        )
+        # make sure the warehouse, database, schema, and stage exist and are in use
+        self.bootstrap()
+
+        # get shared Snowflake connection
+        conn = self.get_connection()
 
         # get Snowflake cursor
         cur = conn.cursor()
 
-        # specify warehouse and database to use
-        cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
-        cur.execute(f'USE SCHEMA {self.SCHEMA}')
-
-        # create stage if it doesn't exist
-        cur.execute(
-            f"CREATE STAGE IF NOT EXISTS {self.STAGE}")
-
         # put file in stage with today's date in the path
-        cur.execute(f"PUT 'file://{self.extract_path}' @{self.STAGE}/{today}/call_log")
+        cur.execute(f"PUT 'file://{self.extract_path}' @{self.STAGE}/{today}/call_log SOURCE_COMPRESSION=GZIP")
 
         # find files that are older than the specified number of days of data to keep
         cur.execute(f'list @{self.STAGE}')
@@ -188,14 +356,11 @@ class Load:
         file_df = pd.DataFrame(fetch)
         # get dates from file paths as series
         dates = pd.to_datetime(file_df[0].str.split('/').str[1])
-        # subtract days_to_keep days from today
-        n_days = (pd.to_datetime(today) - timedelta(days=self.days_to_stage)).strftime('%Y-%m-%d')
+        # subtract days_to_stage days from today
+        cutoff = pd.Timestamp(today) - pd.Timedelta(days=self.days_to_stage)
         # find all dates in our series that are at least days_to_stage days old
-        old_dates = dates[dates <= n_days].astype(str).unique().tolist()
-
-        # remove all old files
-        for date in old_dates:
-            conn.cursor().execute(f'remove @{self.STAGE}/{date}')
+        old_dates = dates[dates <= cutoff].dt.strftime('%Y-%m-%d').unique().tolist()
 
-        # close connector
-        conn.close()
+        # remove all old files in a single multi-statement request
+        if old_dates:
+            conn.execute_string(';\n'.join(f'remove @{self.STAGE}/{date}' for date in old_dates))
@@ -1,10 +1,16 @@
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import traceback
-import json
 import snowflake.connector
 from snowflake.connector.pandas_tools import write_pandas
 import pandas as pd
 
+try:
+    import polars as pl
+except ImportError:
+    pl = None
+
 
 class Log:
     """
@@ -32,7 +38,7 @@ class Log:
         """
 
         # file path where log will be located
-        self.file_path = json.load(open('data_config.json'))['log']['file_path']
+        self.file_path = data_config['log']['file_path']
 
         # create and configure logger object
         self.logger = logging.getLogger(logger_name)
@@ -42,17 +48,23 @@ class Log:
             '%(asctime)s.%(msecs)03d | %(threadName)s | %(filename)s | %(lineno)d | %(funcName)s() | %(levelname)s | '
             '%(message)s', '%Y-%m-%d %H:%M:%S')
 
-        if stream:
-            handler = logging.StreamHandler()
-        else:
-            handler = logging.FileHandler(self.file_path)
-
-        handler.setLevel(logging.DEBUG)
-        handler.setFormatter(formatter)
-
-        # if the logger does not already have a handler, add the one we created
+        # if the logger does not already have a handler, create one and add it
         if not self.logger.handlers:
-            self.logger.addHandler(handler)
+            if stream:
+                handler = logging.StreamHandler()
+            else:
+                handler = logging.FileHandler(self.file_path)
+
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(formatter)
+
+            # the logger only puts records on a queue, and a background listener thread writes them with our handler,
+            # so logging calls do not wait on file writes
+            log_queue = queue.Queue(-1)
+            queue_handler = QueueHandler(log_queue)
+            queue_handler.listener = QueueListener(log_queue, handler, respect_handler_level=True)
+            queue_handler.listener.start()
+            self.logger.addHandler(queue_handler)
 
         # names of columns for log
         self.col_names = data_config['log']['col_names']
@@ -105,48 +117,107 @@ class Log:
         handlers = self.logger.handlers[:]
         for handler in handlers:
             self.logger.removeHandler(handler)
+            # stop the listener, which writes any queued records, then close the handlers it writes with
+            listener = getattr(handler, 'listener', None)
+            if listener is not None:
+                listener.stop()
+                for listener_handler in listener.handlers:
+                    listener_handler.close()
             handler.close()
 
-    def load_log(self):
+    def flush_log(self):
+        """
+        Writes any queued log records to the log file.
+
+        Returns
+        _______
+        None
+        """
+        for handler in self.logger.handlers:
+            listener = getattr(handler, 'listener', None)
+            if listener is not None:
+                # stopping the listener writes every queued record, then restart it so logging can continue
+                listener.stop()
+                listener.start()
+
+    def load_log(self, conn=None):
         """
         Loads the log file into Snowflake.
+
+        Parameters
+        __________
+        conn : SnowflakeConnection
+            open connection to Snowflake to reuse. If None, a new connection is opened and closed after loading.
+
         Returns
         _______
         None
         """
 
-        # connect to Snowflake
-        conn = snowflake.connector.connect(
-            user=self.USER,
-            password=self.PASSWORD,
-            account=self.ACCOUNT
-        )
+        # connect to Snowflake, unless a connection was passed in
+        close_conn = conn is None
+        if close_conn:
+            conn = snowflake.connector.connect(
+                user=self.USER,
+                password=self.PASSWORD,
+                account=self.ACCOUNT
+            )
 
         # get Snowflake cursor
         cur = conn.cursor()
 
         # create warehouse, db, and schema if not exists
-        cur.execute(f'CREATE WAREHOUSE IF NOT EXISTS {self.WAREHOUSE}')
-        cur.execute(f'CREATE DATABASE IF NOT EXISTS {self.DATABASE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
-        cur.execute(f'CREATE SCHEMA IF NOT EXISTS {self.SCHEMA}')
+        self.create_log_schema(cur)
 
-        # specify the warehouse, database, and schema to use when creating the table
-        cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
-        cur.execute(f'USE SCHEMA {self.SCHEMA}')
+        # make sure all log records have been written before reading the log file
+        self.flush_log()
 
         # read the log file into a pandas dataframe
-        file_path = self.file_path
-        col_names = self.col_names
-        log_df = pd.read_table(file_path, sep='|', header=None, names=col_names)
+        log_df = self.read_log_file()
 
         # append log to the end of the log table
         success, num_chunks, num_rows, _ = write_pandas(conn, log_df, self.TABLE_NAME, self.DATABASE, self.SCHEMA,
                                                         quote_identifiers=False)
 
-        # close connector
-        conn.close()
+        # close connector if we opened it
+        if close_conn:
+            conn.close()
+
+    def create_log_schema(self, cur):
+        """
+        Creates the warehouse, database, and schema for the log table if they do not exist, and uses the warehouse.
+        Creating a database or schema makes it the session's current one, so the session's database and schema from
+        before are used again afterwards. A connection shared with the Load object then keeps resolving its tables in
+        the load database and schema.
+
+        Parameters
+        __________
+        cur : SnowflakeCursor
+            cursor of the connection to create the objects with
+
+        Returns
+        _______
+        None
+        """
+
+        # get the session's current database and schema, if it has them
+        current_database, current_schema = cur.execute('SELECT CURRENT_DATABASE(), CURRENT_SCHEMA()').fetchone()
+
+        # create warehouse, db, and schema if not exists
+        # the database and schema are named in each statement, since they may not be the session's current ones
+        cur.execute(f'CREATE WAREHOUSE IF NOT EXISTS {self.WAREHOUSE}')
+        cur.execute(f'CREATE DATABASE IF NOT EXISTS {self.DATABASE}')
+        cur.execute(f'CREATE SCHEMA IF NOT EXISTS {self.DATABASE}.{self.SCHEMA}')
+
+        # specify the warehouse to use
+        cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
+
+        # go back to the session's database and schema from before the log objects were created
+        # the names are quoted, since they are returned exactly as they are stored
+        if current_database is not None:
+            cur.execute(f'USE DATABASE "{current_database}"')
+            if current_schema is not None:
+                cur.execute(f'USE SCHEMA "{current_database}"."{current_schema}"')
 
     def create_log_table(self, load):
         """
@@ -164,38 +235,41 @@ class Log:
         None
         """
 
-        # connect to Snowflake
-        conn = snowflake.connector.connect(
-            user=self.USER,
-            password=self.PASSWORD,
-            account=self.ACCOUNT
-        )
+        # get the Snowflake connection shared by the load object
+        conn = load.get_connection()
 
         # get cursor
         cur = conn.cursor()
 
         # create warehouse, db, and schema if not exists
-        cur.execute(f'CREATE WAREHOUSE IF NOT EXISTS {self.WAREHOUSE}')
-        cur.execute(f'CREATE DATABASE IF NOT EXISTS {self.DATABASE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
-        cur.execute(f'CREATE SCHEMA IF NOT EXISTS {self.SCHEMA}')
+        self.create_log_schema(cur)
 
-        # specify the warehouse, database, and schema to use when creating the table
-        cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
-        cur.execute(f'USE DATABASE {self.DATABASE}')
-        cur.execute(f'USE SCHEMA {self.SCHEMA}')
+        # make sure all log records have been written before reading the log file
+        self.flush_log()
 
         # read log file into pandas dataframe
-        file_path = self.file_path
-        col_names = self.col_names
-        log_df = pd.read_table(file_path, sep='|', header=None, names=col_names)
+        log_df = self.read_log_file()
 
         # make create string using the load function, and create table
-        create = load.get_create_string(self.TABLE_NAME, log_df, self.datetime_columns)
+        create = load.get_create_string(f'{self.DATABASE}.{self.SCHEMA}.{self.TABLE_NAME}', log_df,
+                                        self.datetime_columns)
         cur.execute(create)
 
-        # close connector
-        conn.close()
+    def read_log_file(self):
+        """
+        Reads the log file into a pandas dataframe, using polars' multithreaded csv reader when it is installed.
+
+        Returns
+        _______
+        log_df : Pandas DataFrame
+            dataframe with a column for each field of the log format
+        """
+
+        if pl is not None:
+            return pl.read_csv(self.file_path, separator='|', has_header=False,
+                               new_columns=self.col_names).to_pandas()
+
+        return pd.read_table(self.file_path, sep='|', header=None, names=self.col_names)
 
     def get_logger(self):
         """returns logger class variable"""
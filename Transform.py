@@ -1,9 +1,18 @@
-import snowflake.connector
+import logging
+from datetime import date, timedelta
 from snowflake.connector.errors import ProgrammingError
+from time import time
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
+from Load import connect_snowflake, MAX_DATETIME_CACHE
 from Log import Log
 
+# seconds a cached result is reused for
+_MAX_DATETIME_TTL = 60
+
 
 class Transform:
     """
@@ -13,13 +22,25 @@ class Transform:
     _______
     transform_data(df):
         Transforms the data in the dataframe parameter.
-    transform_call_log(df):
-        Transforms Zoom call log data.
+    transform_stream(chunks):
+        Transforms each dataframe in an iterable of chunks.
     get_max_snowflake_time():
         Gets the most recent call time currently in Snowflake.
+    get_max_query(lookback_days):
+        Produces the SQL query for the call log table's most recent call time and row count.
+    bootstrap():
+        Queries the call log table's most recent call time and row count in Snowflake, once per Transform object.
+    get_connection():
+        Gets the Snowflake connection used by this object, connecting on first use.
+    close():
+        Closes the Snowflake connection.
+    parse_date_times(date_times):
+        Parses Zoom call times into UTC datetimes.
+    downcast_numeric(df):
+        Downcasts integer columns to the smallest type that holds their values.
     """
 
-    def __init__(self, data_config):
+    def __init__(self, data_config, conn=None):
         """
         Constructs all the necessary attributes for the transform object.
 
@@ -27,6 +48,9 @@ class Transform:
         __________
             data_config : dict
                 dictionary containing ETL specifications
+            conn : SnowflakeConnection
+                open connection to Snowflake to share with other objects. If None, a connection is opened on first
+                use and closed by close().
         """
 
         # get Snowflake parameters from data_config
@@ -37,6 +61,24 @@ class Transform:
         self.DATABASE = data_config['load']['database']
         self.SCHEMA = data_config['load']['schema']
 
+        # Snowflake table holding the call logs, and its column of call times
+        self.table_name = data_config['transform']['table_name']
+        self.datetime_column = data_config['transform']['datetime_column']
+        # number of days back from today to look for the most recent call time, or None to look through the whole table
+        self.lookback_days = data_config['transform']['lookback_days']
+
+        # Snowflake connection, created on first use unless one was passed in
+        # a connection that was passed in belongs to the caller, and is not closed by this object
+        self.conn = conn
+        self.owns_conn = conn is None
+
+        # most recent call time and number of rows in Snowflake, queried on first use by bootstrap
+        self.bootstrapped = False
+        self.max_datetime = None
+        self.row_count = None
+        # number of days back from today that row_count covers, or None if it covers the whole table
+        self.row_count_days = None
+
         # initialize logger
         self.log = Log('zoom_log', data_config)
         self.logger = self.log.get_logger()
@@ -56,14 +98,108 @@ class Transform:
             dataframe containing transformed Zoom call data
         """
 
-        # transform data
-        df = self.transform_call_log(df)
+        # get subset of data that is not in Snowflake
+
+        # get max datetime in Snowflake
+        max_datetime = self.get_max_snowflake_time()
+
+        # log max_datetime
+        # the message is only formatted if info messages are logged
+        self.logger.info('The most recent datetime in Snowflake prior to load was: %s', max_datetime)
+
+        # select only Zoom data that is after the max time in Snowflake
+        # parse the call times once, and compare the raw datetime64 array to a single timestamp, taking matching rows
+        # by position
+        # (the extracted columns are lower case until they are relabeled below)
+        date_times = self.parse_date_times(df[self.datetime_column.lower()])
+        # both sides are nanosecond datetime64, so the comparison is a plain int64 compare with no unit conversion
+        # if the table is empty, there is no max datetime, and every call after the epoch is kept
+        if pd.isna(max_datetime):
+            threshold64 = np.datetime64('1970-01-01', 'ns')
+        else:
+            threshold64 = pd.Timestamp(max_datetime).as_unit('ns').to_datetime64()
+        date_times = date_times.astype('datetime64[ns]', copy=False)
+        mask = date_times > threshold64
+        # the kept rows get a fresh range index, rather than carrying the labels of the rows around them
+        df = df.iloc[mask].reset_index(drop=True)
+
+        # rename id to record_id, since id is a keyword in Snowflake, and make columns upper case
+        # relabeling the columns of the filtered frame in one pass over the labels avoids the frame copy made by rename
+        df.columns = ['RECORD_ID' if col == 'id' else str(col).upper() for col in df.columns]
+
+        # log some summary stats about the transformed dataframe
+        # the min and max come from the already parsed call times of the kept rows, and are skipped entirely when info
+        # messages are not logged
+        if self.logger.isEnabledFor(logging.INFO):
+            kept_date_times = date_times[mask]
+            if kept_date_times.size:
+                min_kept, max_kept = pd.Timestamp(kept_date_times.min()), pd.Timestamp(kept_date_times.max())
+            else:
+                min_kept, max_kept = None, None
+            self.logger.info('The transformed dataframe has max datetime of %s, min datetime of %s, %d rows, and %d '
+                             'columns.', max_kept, min_kept, df.shape[0], df.shape[1])
+
+        # shrink integer columns before they are loaded
+        df = self.downcast_numeric(df)
 
         return df
 
-    def transform_call_log(self, df):
+    def transform_stream(self, chunks):
         """
-        Transforms Zoom call log data.
+        Transforms each dataframe in an iterable of chunks. Snowflake is queried once for the whole stream, and every
+        chunk is compared to the same max datetime.
+
+        Parameters
+        __________
+        chunks : iterable
+            iterable of dataframes containing Zoom call data
+
+        Returns
+        _______
+        chunks : generator
+            generator of dataframes containing transformed Zoom call data
+        """
+
+        # query Snowflake before the first chunk is transformed
+        self.bootstrap()
+
+        for df in chunks:
+            yield self.transform_data(df)
+
+    def parse_date_times(self, date_times):
+        """
+        Parses Zoom call times into UTC datetimes. The times are cast with arrow's compute kernels, which read the arrow
+        backed strings from the extract directly. Times arrow cannot parse fall back to pandas, and become NaT if pandas
+        cannot parse them either.
+
+        Parameters
+        __________
+        date_times : Pandas Series
+            series of ISO 8601 call time strings
+
+        Returns
+        _______
+        date_times : numpy array
+            datetime64 array of the call times in UTC
+        """
+
+        values = pa.array(date_times)
+
+        # Zoom call times end in a zone offset ('Z'), but fixed format times without an offset are also parsed by
+        # arrow, as naive times in UTC, rather than falling back to pandas
+        for timestamp_type in (pa.timestamp('ns', tz='UTC'), pa.timestamp('ns')):
+            try:
+                return pc.cast(values, timestamp_type).to_numpy(zero_copy_only=False)
+            except pa.ArrowInvalid:
+                pass
+
+        return pd.to_datetime(date_times, cache=True, errors='coerce').values
+
+    def downcast_numeric(self, df):
+        """
+        Downcasts integer columns to the smallest type that holds their values. The columns are replaced in the
+        dataframe parameter. Float columns are left as they are, since downcasting them loses precision.
+
         Parameters
         __________
         df : Pandas DataFrame
@@ -72,69 +208,140 @@ class Transform:
         Returns
         _______
         df : Pandas DataFrame
-            dataframe containing transformed Zoom call data
+            dataframe with downcast integer columns
         """
 
-        # rename id to record_id, since id is a keyword in Snowflake
-        df = df.rename(columns={'id': 'record_id'})
+        # select by kind rather than by name, so arrow backed columns are included
+        for col in df.select_dtypes('integer').columns:
+            df[col] = pd.to_numeric(df[col], downcast='integer')
 
-        # make columns upper case
-        df.columns = map(lambda x: str(x).upper(), df.columns)
+        return df
 
-        # get subset of data that is not in Snowflake
+    def get_connection(self):
+        """
+        Gets the Snowflake connection used by this object, connecting on first use.
 
-        # get max datetime in Snowflake
-        max_datetime = self.get_max_snowflake_time()
+        Returns
+        _______
+        conn : SnowflakeConnection
+            open connection to Snowflake
+        """
 
-        # log max_datetime
-        self.logger.info(f'The most recent datetime in Snowflake prior to load was: {max_datetime}')
+        # connect to snowflake only once per Transform object
+        if self.conn is None:
+            # the warehouse, database, and schema are set as part of connecting, rather than with USE statements
+            # the connection is opened the same way as the Load object's, since Engine shares it with the Load object
+            self.conn = connect_snowflake(self.USER, self.PASSWORD, self.ACCOUNT, self.WAREHOUSE, self.DATABASE,
+                                          self.SCHEMA)
 
-        # select only Zoom data that is after the max time in Snowflake
-        df = df[pd.to_datetime(df['DATE_TIME']) > str(max_datetime)]
+        return self.conn
 
-        # log some summary stats about the transformed dataframe
-        self.logger.info(
-            f"The transformed dataframe has max datetime of {df['DATE_TIME'].max()},"
-            f"min datetime of {df['DATE_TIME'].min()},"
-            f"{df.shape[0]} rows,"
-            f"and {df.shape[1]} columns.")
+    def close(self):
+        """
+        Closes the Snowflake connection, if it was opened by this object.
 
-        return df
+        Returns
+        _______
+        None
+        """
+
+        if self.conn is not None and self.owns_conn:
+            self.conn.close()
+            self.conn = None
 
     def get_max_snowflake_time(self):
         """
-        Gets the most recent call time currently in Snowflake.
+        Gets the most recent call time currently in Snowflake. The result is queried once and reused by later calls.
 
         Returns
         _______
-        max_datetime : datetime
-            the most recent datetime in the date_time column of Zoom_Call_Logs in Snowflake
+        max_datetime : Pandas Timestamp
+            the most recent datetime in the date_time column of Zoom_Call_Logs in Snowflake, NaT if the table is empty
         """
 
-        # connect to Snowflake
-        conn = snowflake.connector.connect(
-            user=self.USER,
-            password=self.PASSWORD,
-            account=self.ACCOUNT
-        )
+        self.bootstrap()
 
-        # get cursor
-        cur = conn.cursor()
+        return self.max_datetime
 
-        # specify the warehouse, database, and schema to use when creating the table
-        try:
-            cur.execute(f'USE WAREHOUSE {self.WAREHOUSE}')
-            cur.execute(f'USE DATABASE {self.DATABASE}')
-            cur.execute(f'USE SCHEMA {self.SCHEMA}')
-        except ProgrammingError as er:
-            print(f'The Warehouse, Database, or Schema does not exist\n {er}')
-            raise
+    def bootstrap(self):
+        """
+        Queries the call log table's most recent call time and row count in Snowflake, in a single query. Only runs
+        once per Transform object, and a result queried by any Transform object in the last minute is reused.
+
+        Returns
+        _______
+        None
+        """
+
+        if self.bootstrapped:
+            return
+
+        key = (self.ACCOUNT, self.DATABASE, self.SCHEMA, self.table_name, self.datetime_column, self.lookback_days)
+
+        # reuse the result of a recent query of the same table in this process, skipping the round trip to Snowflake
+        cached = MAX_DATETIME_CACHE.get(key)
+        if cached is not None and time() < cached[-1]:
+            self.max_datetime, self.row_count, self.row_count_days, _ = cached
+            source = 'cached'
+        else:
+            # get cursor
+            cur = self.get_connection().cursor()
+
+            # query Snowflake to get most recent date in the date_time column, along with the number of rows
+            try:
+                query = cur.execute(self.get_max_query(self.lookback_days))
+            except ProgrammingError as er:
+                print(f'The Warehouse, Database, Schema, or Table does not exist\n {er}')
+                raise
+
+            # get the single row result from the previous query through the connector's arrow path
+            result = query.fetch_pandas_all()
+            self.row_count_days = self.lookback_days
+
+            # if no calls were loaded within the lookback, the most recent call time is older than the lookback, so
+            # query the whole table for it
+            if self.lookback_days is not None and pd.isna(result['MAX_DATETIME'].iloc[0]):
+                result = cur.execute(self.get_max_query(None)).fetch_pandas_all()
+                self.row_count_days = None
+
+            self.max_datetime = result['MAX_DATETIME'].iloc[0]
+            self.row_count = result['ROW_COUNT'].iloc[0]
+            MAX_DATETIME_CACHE[key] = (self.max_datetime, self.row_count, self.row_count_days,
+                                       time() + _MAX_DATETIME_TTL)
+            source = 'queried'
+
+        if self.row_count_days is None:
+            self.logger.info('%s has %s rows in Snowflake (%s)', self.table_name, self.row_count, source)
+        else:
+            self.logger.info('%s has %s rows from the last %s days in Snowflake (%s)', self.table_name,
+                             self.row_count, self.row_count_days, source)
+
+        self.bootstrapped = True
+
+    def get_max_query(self, lookback_days):
+        """
+        Produces the SQL query for the call log table's most recent call time and row count.
+
+        Parameters
+        __________
+        lookback_days : int
+            number of days back from today to look for the most recent call time. If None, the whole table is queried.
+
+        Returns
+        _______
+        query : str
+            SQL string selecting MAX_DATETIME and ROW_COUNT from the call log table
+        """
 
-        # query Snowflake to get most recent date in the date_time column
-        query = cur.execute('SELECT MAX(DATE_TIME)'
-                            'FROM ZOOM_CALL_LOGS')
+        query = f'SELECT MAX({self.datetime_column}) AS MAX_DATETIME, COUNT(*) AS ROW_COUNT FROM {self.table_name}'
 
-        # get the single result from the previous query
-        max_datetime = query.fetchone()[0]
+        # without a predicate, both aggregates are answered from table metadata, and the query text never changes, so
+        # repeat runs can be answered from Snowflake's result cache
+        if lookback_days is None:
+            return query
 
-        return max_datetime
+        # with a lookback, only micro-partitions holding recent calls are scanned, and the row count is of those calls
+        # the cutoff is a date literal rather than CURRENT_TIMESTAMP(), so the result cache can still answer repeat runs
+        # on the same day
+        cutoff = date.today() - timedelta(days=lookback_days)
+        return f"{query} WHERE {self.datetime_column} >= '{cutoff:%Y-%m-%d}'"